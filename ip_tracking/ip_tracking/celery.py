@@ -19,21 +19,8 @@ def debug_task(self):
     print(f'Request: {self.request!r}')
 
 
-# Configure Celery Beat schedule for periodic tasks
-app.conf.beat_schedule = {
-    'monitor-suspicious-ips-hourly': {
-        'task': 'ip_tracking.tasks.monitor_suspicious_ips',
-        'schedule': 3600.0,  # Every hour (3600 seconds)
-    },
-    'cleanup-old-suspicious-flags-daily': {
-        'task': 'ip_tracking.tasks.cleanup_old_suspicious_flags',
-        'schedule': 86400.0,  # Every day (86400 seconds)
-    },
-    'auto-block-severely-suspicious-ips-daily': {
-        'task': 'ip_tracking.tasks.auto_block_suspicious_ips',
-        'schedule': 86400.0,  # Every day (86400 seconds)
-    },
-}
+# The Celery Beat schedule is defined once, in CELERY_BEAT_SCHEDULE (settings.py),
+# and loaded by config_from_object above.
 
 # Configure Celery settings
 app.conf.update(
@@ -47,7 +34,9 @@ app.conf.update(
     enable_utc=True,
     
     # Worker settings
-    worker_prefetch_multiplier=1,
+    # Security tasks are IO-bound (DB scans, geolocation calls); a small prefetch
+    # keeps workers busy without hoarding tasks
+    worker_prefetch_multiplier=2,
     task_acks_late=True,
     
     # Result backend (optional - for storing task results)
@@ -30,14 +30,26 @@ class Command(BaseCommand):
         force = options['force']
         
         try:
-            # Check if IP already exists
-            blocked_ip, created = BlockedIP.objects.get_or_create(
-                ip_address=ip_address,
-                defaults={
-                    'reason': reason,
-                    'created_at': timezone.now()
-                }
-            )
+            # Insert (or with --force, upsert) in one atomic statement, no get-then-create race
+            # created_at is read back from the row on insert, so compare against this local value
+            blocked_at = timezone.now()
+            new_blocked_ip = BlockedIP(ip_address=ip_address, reason=reason, created_at=blocked_at)
+            if force:
+                BlockedIP.objects.bulk_create(
+                    [new_blocked_ip],
+                    update_conflicts=True,
+                    unique_fields=['ip_address'],
+                    update_fields=['reason']
+                )
+            else:
+                BlockedIP.objects.bulk_create([new_blocked_ip], ignore_conflicts=True)
+            
+            # The stored row keeps its original created_at if the IP was already blocked
+            blocked_ip = BlockedIP.objects.get(ip_address=ip_address)
+            created = blocked_ip.created_at == blocked_at
+            
+            # Drop any cached "not blocked" status for this IP
+            BlockedIP.invalidate_cache([ip_address])
             
             if created:
                 self.stdout.write(
@@ -47,9 +59,7 @@ class Command(BaseCommand):
                 )
             else:
                 if force:
-                    # Update existing blocked IP
-                    blocked_ip.reason = reason
-                    blocked_ip.save()
+                    # Existing blocked IP was updated by the upsert
                     self.stdout.write(
                         self.style.SUCCESS(
                             f'Updated blocked IP address: {ip_address}'
@@ -26,9 +26,12 @@ class Command(BaseCommand):
         
         cutoff_time = timezone.now() - timedelta(hours=hours)
         
-        # Find expired cache entries
-        expired_entries = IPGeolocationCache.objects.filter(cached_at__lt=cutoff_time)
-        count = expired_entries.count()
+        if dry_run:
+            self.preview_expired_entries(cutoff_time, hours)
+            return
+        
+        # Actually delete expired entries in a single statement
+        count = IPGeolocationCache.delete_expired(cutoff_time)
         
         if count == 0:
             self.stdout.write(
@@ -36,25 +39,36 @@ class Command(BaseCommand):
             )
             return
         
-        if dry_run:
-            self.stdout.write(
-                self.style.WARNING(
-                    f'DRY RUN: Would delete {count} expired cache entries older than {hours} hours.'
-                )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Successfully deleted {count} expired cache entries older than {hours} hours.'
             )
-            
-            # Show some examples
-            for entry in expired_entries[:5]:
-                self.stdout.write(f'  - {entry.ip_address} (cached at {entry.cached_at})')
-            
-            if count > 5:
-                self.stdout.write(f'  ... and {count - 5} more entries')
-        else:
-            # Actually delete expired entries
-            expired_entries.delete()
-            
+        )
+    
+    def preview_expired_entries(self, cutoff_time, hours):
+        """Show what would be deleted without deleting anything."""
+        # Find expired cache entries
+        expired_entries = IPGeolocationCache.objects.filter(cached_at__lt=cutoff_time)
+        
+        # Fetch one more row than is shown, so small result sets need no COUNT query
+        sample = list(expired_entries.only('ip_address', 'cached_at')[:6])
+        count = len(sample) if len(sample) <= 5 else expired_entries.count()
+        
+        if count == 0:
             self.stdout.write(
-                self.style.SUCCESS(
-                    f'Successfully deleted {count} expired cache entries older than {hours} hours.'
-                )
+                self.style.SUCCESS(f'No expired cache entries found (older than {hours} hours).')
+            )
+            return
+        
+        self.stdout.write(
+            self.style.WARNING(
+                f'DRY RUN: Would delete {count} expired cache entries older than {hours} hours.'
             )
+        )
+        
+        # Show some examples
+        for entry in sample[:5]:
+            self.stdout.write(f'  - {entry.ip_address} (cached at {entry.cached_at})')
+        
+        if count > 5:
+            self.stdout.write(f'  ... and {count - 5} more entries')
@@ -1,10 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django.test import Client
 from django.contrib.auth.models import User
 from django.urls import reverse
-import time
+from ip_tracking.rate_limit_middleware import RateLimitMiddleware
 import json
 
+# The test client sends every request from this address (its default REMOTE_ADDR)
+TEST_CLIENT_IP = '127.0.0.1'
+
 
 class Command(BaseCommand):
     help = 'Test rate limiting functionality for different user types'
@@ -63,24 +68,26 @@ class Command(BaseCommand):
         self.stdout.write(f'Limit: {limit} requests per minute')
         self.stdout.write('-' * 50)
         
-        # Make requests up to the limit
+        # Fire all requests at once to simulate a burst, trying to exceed the limit
+        total_requests = limit + 2
+        with ThreadPoolExecutor(max_workers=total_requests) as executor:
+            status_codes = list(executor.map(
+                lambda _: self.send_request(client, endpoint),
+                range(total_requests)
+            ))
+        
         successful_requests = 0
         blocked_requests = 0
         
-        for i in range(limit + 2):  # Try to exceed the limit
-            response = client.get(endpoint)
-            
-            if response.status_code == 200:
+        for i, status_code in enumerate(status_codes):
+            if status_code == 200:
                 successful_requests += 1
                 self.stdout.write(f'Request {i+1}: SUCCESS (200)')
-            elif response.status_code == 429:  # Too Many Requests
+            elif status_code == 429:  # Too Many Requests
                 blocked_requests += 1
                 self.stdout.write(f'Request {i+1}: BLOCKED (429) - Rate limit exceeded')
             else:
-                self.stdout.write(f'Request {i+1}: UNEXPECTED ({response.status_code})')
-            
-            # Small delay between requests
-            time.sleep(0.1)
+                self.stdout.write(f'Request {i+1}: UNEXPECTED ({status_code})')
         
         # Summary
         self.stdout.write('-' * 50)
@@ -98,17 +105,32 @@ class Command(BaseCommand):
                 self.style.WARNING('⚠ Rate limiting may not be working as expected.')
             )
         
-        # Test rate limit reset after waiting
-        self.stdout.write('\nWaiting 65 seconds for rate limit to reset...')
-        time.sleep(65)
+        # Test rate limit reset by expiring the window instead of waiting 65 seconds
+        self.stdout.write('\nResetting the rate limit window...')
+        # Only the test client's counter is deleted; the rest of the cache is left alone.
+        # The middleware instance is only used for its key helpers, so get_response is a no-op.
+        RateLimitMiddleware(lambda request: None).reset_rate_limit(TEST_CLIENT_IP, user)
         
         # Try one more request
         response = client.get(endpoint)
         if response.status_code == 200:
             self.stdout.write(
-                self.style.SUCCESS('✓ Rate limit reset successfully after waiting!')
+                self.style.SUCCESS('✓ Rate limit reset successfully after clearing the window!')
             )
         else:
             self.stdout.write(
                 self.style.WARNING('⚠ Rate limit may not have reset properly.')
             )
+    
+    def send_request(self, client, endpoint):
+        """
+        Send one GET request from a worker thread and return its status code.
+        Each thread uses its own Client (which is not thread-safe) with the same session cookies.
+        """
+        thread_client = Client()
+        thread_client.cookies.update(client.cookies)
+        try:
+            return thread_client.get(endpoint).status_code
+        finally:
+            # Each thread opens its own database connection
+            connection.close()
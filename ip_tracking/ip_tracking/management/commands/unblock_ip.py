@@ -16,11 +16,12 @@ class Command(BaseCommand):
         ip_address = options['ip_address']
         
         try:
-            # Try to find and delete the blocked IP
-            blocked_ip = BlockedIP.objects.filter(ip_address=ip_address).first()
+            # Delete the blocked IP in a single query; the raw DELETE sends no
+            # post_delete signal, so the cache is invalidated explicitly below
+            deleted = BlockedIP.delete_ip(ip_address)
             
-            if blocked_ip:
-                blocked_ip.delete()
+            if deleted:
+                BlockedIP.invalidate_cache([ip_address])
                 self.stdout.write(
                     self.style.SUCCESS(
                         f'Successfully unblocked IP address: {ip_address}'
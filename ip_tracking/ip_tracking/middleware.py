@@ -1,12 +1,209 @@
+import atexit
+import ipaddress
 import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import timedelta
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
 from django.utils import timezone
 from django.http import HttpResponseForbidden
 from .models import RequestLog, BlockedIP, IPGeolocationCache
+from .tasks import log_request_batch, save_ip_geolocation
 import dj_database_url
 
 logger = logging.getLogger(__name__)
 
+
+@lru_cache(maxsize=4096)
+def is_valid_ip(ip_address):
+    """Return True if ip_address is a valid IPv4 or IPv6 address."""
+    try:
+        ipaddress.ip_address(ip_address)
+        return True
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=4096)
+def is_private_address(ip_address):
+    """Return True for private, loopback and other non-routable addresses."""
+    try:
+        return ipaddress.ip_address(ip_address).is_private
+    except ValueError:
+        return False
+
+
+# Shared HTTP session so geolocation API calls reuse pooled keep-alive connections
+geolocation_http = requests.Session()
+geolocation_http.mount('http://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=1, backoff_factor=0.1)
+))
+
+# Geolocation data is cached for 24 hours, in process, in the shared cache and in the database
+GEOLOCATION_CACHE_HOURS = 24
+GEOLOCATION_MEMORY_CACHE_SIZE = 10000
+GEOLOCATION_API_TIMEOUT = 5  # seconds
+
+
+def geolocation_cache_key(ip_address):
+    """Return the shared cache key holding the geolocation of an IP address."""
+    return f"geolocation:{ip_address}"
+
+
+class LocalTTLCache:
+    """
+    Small thread-safe in-process cache with per-entry expiry.
+    The least recently used entry is evicted once maxsize is reached.
+    """
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+    
+    def get(self, key):
+        """Return the cached value, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value, ttl=None):
+        """Store a value for ttl seconds (defaults to the cache-wide ttl)."""
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+# Request logs are buffered in memory and written in batches off the request path
+# (batch size and flush interval can be tuned in settings)
+REQUEST_LOG_BATCH_SIZE = getattr(settings, 'IP_TRACKING_BULK_BATCH_SIZE', 500)
+REQUEST_LOG_FLUSH_INTERVAL = getattr(settings, 'IP_TRACKING_LOG_FLUSH_INTERVAL', 1.0)  # seconds
+REQUEST_LOG_QUEUE_SIZE = getattr(settings, 'IP_TRACKING_LOG_QUEUE_SIZE', 10000)
+
+
+class RequestLogWriter:
+    """
+    Buffers unsaved RequestLog instances and writes them with bulk_create
+    from a background thread, so requests never wait on an INSERT.
+    A batch is written once it reaches batch_size entries or flush_interval seconds.
+    """
+    
+    def __init__(self, batch_size=REQUEST_LOG_BATCH_SIZE, flush_interval=REQUEST_LOG_FLUSH_INTERVAL,
+                 max_queue_size=REQUEST_LOG_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def enqueue(self, request_log):
+        """Queue a RequestLog for writing without blocking the caller."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(request_log)
+        except queue.Full:
+            logger.warning("Request log queue is full, dropping log for IP: %s", request_log.ip_address)
+    
+    def flush(self):
+        """Write every queued entry immediately (used at interpreter exit)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.write(batch)
+    
+    def write(self, batch):
+        """Hand a batch to a Celery worker if enabled, otherwise insert it directly."""
+        if getattr(settings, 'IP_TRACKING_ASYNC_REQUEST_LOGGING', False):
+            try:
+                log_request_batch.apply_async(
+                    args=[[self.serialize(request_log) for request_log in batch]],
+                    compression='gzip',
+                    retry=False,
+                )
+                return
+            except Exception as e:
+                logger.warning("Could not dispatch %d request logs to Celery, writing directly: %s", len(batch), e)
+        
+        self.bulk_create(batch)
+    
+    def bulk_create(self, batch):
+        """Insert a batch of RequestLog rows in a single bulk query, falling back to one row at a time."""
+        try:
+            close_old_connections()
+            RequestLog.bulk_insert(batch, batch_size=self.batch_size)
+        except Exception as e:
+            logger.error("Failed to save %d request logs: %s", len(batch), e)
+    
+    @staticmethod
+    def serialize(request_log):
+        """Convert an unsaved RequestLog into JSON-serializable task arguments."""
+        return {
+            'ip_address': request_log.ip_address,
+            'timestamp': request_log.timestamp.isoformat(),
+            'path': request_log.path,
+            'country': request_log.country,
+            'city': request_log.city,
+        }
+    
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-log-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+    
+    def _run(self):
+        while True:
+            self.write(self._next_batch())
+    
+    def _next_batch(self):
+        # Block until there is work, then collect more until the batch is full or the interval elapses
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+
+request_log_writer = RequestLogWriter()
+
+
 class IPTrackingMiddleware:
     """
     Middleware to track and log IP addresses, timestamps, and request paths.
@@ -15,105 +212,169 @@ class IPTrackingMiddleware:
     
     def __init__(self, get_response):
         self.get_response = get_response
+        self.geolocation_cache = LocalTTLCache(
+            maxsize=GEOLOCATION_MEMORY_CACHE_SIZE,
+            ttl=GEOLOCATION_CACHE_HOURS * 3600
+        )
+        # One geolocation fetch in flight per IP; concurrent callers wait on its Future
+        self._geolocation_inflight = {}
+        self._geolocation_inflight_lock = threading.Lock()
     
     def __call__(self, request):
-        # Check if IP is blocked before processing
-        ip_address = self.get_client_ip(request)
+        # Resolve the client IP once; later middleware and views can reuse request.client_ip
+        ip_address = request.client_ip = self.get_client_ip(request)
         
         # Check if IP is blocked
         if self.is_ip_blocked(ip_address):
-            logger.warning(f"Blocked request from blocked IP: {ip_address}")
+            logger.warning("Blocked request from blocked IP: %s", ip_address)
             return HttpResponseForbidden("Access denied. Your IP address is blocked.")
         
         # Process request before view
         self.process_request(request)
         
-        # Get response from view
-        response = self.get_response(request)
-        
-        # Process response after view
-        self.process_response(request, response)
-        
-        return response
+        # No response-side processing; hand the view's response straight back
+        return self.get_response(request)
     
     def process_request(self, request):
         """Process the request and log details."""
-        # Get client IP address
-        ip_address = self.get_client_ip(request)
+        # Client IP address resolved in __call__
+        ip_address = request.client_ip
         path = request.path
         timestamp = timezone.now()
         
         # Get geolocation data
         country, city = self.get_ip_geolocation(ip_address)
         
-        # Log to console/logs
-        location_info = f" ({city}, {country})" if city and country else ""
-        logger.info(f"Request from IP: {ip_address}{location_info}, Path: {path}, Time: {timestamp}")
+        # Log to console/logs (only build the message if INFO is enabled)
+        if logger.isEnabledFor(logging.INFO):
+            location_info = f" ({city}, {country})" if city and country else ""
+            logger.info("Request from IP: %s%s, Path: %s, Time: %s", ip_address, location_info, path, timestamp)
         
-        # Save to database
-        try:
-            RequestLog.objects.create(
-                ip_address=ip_address,
-                timestamp=timestamp,
-                path=path,
-                country=country,
-                city=city
-            )
-        except Exception as e:
-            logger.error(f"Failed to save request log: {e}")
-    
-    def process_response(self, request, response):
-        """Process the response (can be used for additional logging if needed)."""
-        return response
+        # Queue for a batched write to the database (values are fitted to the columns first)
+        request_log = RequestLog.build(ip_address, path, timestamp, country, city)
+        if request_log is None:
+            logger.warning("Not logging request with invalid client IP: %r", ip_address)
+            return
+        request_log_writer.enqueue(request_log)
     
     def get_client_ip(self, request):
         """Extract the client IP address from the request."""
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
+            # First entry is the original client; partition avoids splitting the whole chain
+            client_ip = x_forwarded_for.partition(',')[0].strip()
+            # The header is client-controlled; fall back to the peer address if it isn't an IP
+            if is_valid_ip(client_ip):
+                return client_ip
+        return request.META.get('REMOTE_ADDR')
     
     def is_ip_blocked(self, ip_address):
-        """Check if the given IP address is blocked."""
+        """Check if the given IP address is blocked, using cache if available."""
         try:
-            return BlockedIP.objects.filter(ip_address=ip_address).exists()
+            return BlockedIP.is_blocked(ip_address)
         except Exception as e:
-            logger.error(f"Error checking if IP {ip_address} is blocked: {e}")
+            logger.error("Error checking if IP %s is blocked: %s", ip_address, e)
             return False
     
     def get_ip_geolocation(self, ip_address):
         """Get geolocation data for an IP address, using cache if available."""
+        # Local/private IPs have no geolocation, skip the lookups entirely
+        if self.is_private_ip(ip_address):
+            return None, None
+        
         try:
-            # Check cache first
-            cache_entry = IPGeolocationCache.objects.filter(ip_address=ip_address).first()
+            # Check in-process cache first
+            location = self.geolocation_cache.get(ip_address)
+            if location is not None:
+                return location
             
-            if cache_entry and not cache_entry.is_expired(hours=24):
-                logger.debug(f"Using cached geolocation data for IP: {ip_address}")
-                return cache_entry.country, cache_entry.city
+            # Then the shared cache, which expires entries on its own
+            cached = cache.get(geolocation_cache_key(ip_address))
+            if cached is not None:
+                country, city, expires_at = cached
+                # Keep it in process only for as long as the shared entry stays valid
+                self.geolocation_cache.set(ip_address, (country, city), ttl=expires_at - time.time())
+                return country, city
             
-            # If not in cache or expired, fetch from API
-            country, city = self.fetch_ip_geolocation_from_api(ip_address)
-            
-            # Update or create cache entry
-            if country or city:
-                IPGeolocationCache.objects.update_or_create(
+            # Then the database, the persistent copy of the cache
+            cache_entry = (
+                IPGeolocationCache.objects
+                .filter(
                     ip_address=ip_address,
-                    defaults={
-                        'country': country,
-                        'city': city,
-                        'cached_at': timezone.now()
-                    }
+                    cached_at__gt=timezone.now() - timedelta(hours=GEOLOCATION_CACHE_HOURS)
                 )
-                logger.info(f"Cached geolocation data for IP: {ip_address}")
+                .values_list('country', 'city', 'cached_at')
+                .first()
+            )
             
-            return country, city
+            if cache_entry:
+                logger.debug("Using cached geolocation data for IP: %s", ip_address)
+                country, city, cached_at = cache_entry
+                self.cache_ip_geolocation(ip_address, country, city, cached_at)
+                return country, city
+            
+            # If not in cache or expired, fetch from API (once per IP across threads)
+            return self.refresh_ip_geolocation(ip_address)
             
         except Exception as e:
-            logger.error(f"Error getting geolocation for IP {ip_address}: {e}")
+            logger.error("Error getting geolocation for IP %s: %s", ip_address, e)
             return None, None
     
+    def refresh_ip_geolocation(self, ip_address):
+        """
+        Fetch geolocation data from the API and update both caches.
+        Concurrent calls for the same IP share a single API request.
+        """
+        with self._geolocation_inflight_lock:
+            future = self._geolocation_inflight.get(ip_address)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._geolocation_inflight[ip_address] = future
+        
+        if not is_leader:
+            logger.debug("Waiting for in-flight geolocation fetch for IP: %s", ip_address)
+            # Allow for the API timeout plus one retry
+            return future.result(timeout=GEOLOCATION_API_TIMEOUT * 2)
+        
+        try:
+            country, city = self.fetch_ip_geolocation_from_api(ip_address)
+            
+            # Cache the result, and persist it to the database off the request path
+            if country or city:
+                self.cache_ip_geolocation(ip_address, country, city, timezone.now())
+                self.persist_ip_geolocation(ip_address, country, city)
+                logger.info("Cached geolocation data for IP: %s", ip_address)
+            
+            future.set_result((country, city))
+            return country, city
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._geolocation_inflight_lock:
+                self._geolocation_inflight.pop(ip_address, None)
+    
+    def cache_ip_geolocation(self, ip_address, country, city, cached_at):
+        """Store geolocation data in process and in the shared cache until it expires."""
+        expires_at = (cached_at + timedelta(hours=GEOLOCATION_CACHE_HOURS)).timestamp()
+        ttl = expires_at - time.time()
+        if ttl <= 0:
+            return
+        self.geolocation_cache.set(ip_address, (country, city), ttl=ttl)
+        cache.set(geolocation_cache_key(ip_address), (country, city, expires_at), ttl)
+    
+    def persist_ip_geolocation(self, ip_address, country, city):
+        """Save geolocation data to the database from a Celery worker if enabled, otherwise directly."""
+        if getattr(settings, 'IP_TRACKING_ASYNC_REQUEST_LOGGING', False):
+            try:
+                save_ip_geolocation.apply_async(args=[ip_address, country, city], retry=False)
+                return
+            except Exception as e:
+                logger.warning("Could not dispatch geolocation for IP %s to Celery, saving directly: %s", ip_address, e)
+        
+        save_ip_geolocation(ip_address, country, city)
+    
     def fetch_ip_geolocation_from_api(self, ip_address):
         """Fetch geolocation data from external API."""
         try:
@@ -123,7 +384,7 @@ class IPTrackingMiddleware:
             
             # Use free IP geolocation API (ipapi.co)
             api_url = f"http://ip-api.com/json/{ip_address}"
-            response = requests.get(api_url, timeout=5)
+            response = geolocation_http.get(api_url, timeout=GEOLOCATION_API_TIMEOUT)
             
             if response.status_code == 200:
                 data = response.json()
@@ -131,26 +392,20 @@ class IPTrackingMiddleware:
                 if data.get('status') == 'success':
                     country = data.get('country')
                     city = data.get('city')
-                    logger.info(f"Fetched geolocation for IP {ip_address}: {city}, {country}")
+                    logger.info("Fetched geolocation for IP %s: %s, %s", ip_address, city, country)
                     return country, city
                 else:
-                    logger.warning(f"API returned error for IP {ip_address}: {data.get('message', 'Unknown error')}")
+                    logger.warning("API returned error for IP %s: %s", ip_address, data.get('message', 'Unknown error'))
             else:
-                logger.warning(f"API request failed for IP {ip_address}: HTTP {response.status_code}")
+                logger.warning("API request failed for IP %s: HTTP %s", ip_address, response.status_code)
                 
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request error fetching geolocation for IP {ip_address}: {e}")
+            logger.error("Request error fetching geolocation for IP %s: %s", ip_address, e)
         except Exception as e:
-            logger.error(f"Unexpected error fetching geolocation for IP {ip_address}: {e}")
+            logger.error("Unexpected error fetching geolocation for IP %s: %s", ip_address, e)
         
         return None, None
     
     def is_private_ip(self, ip_address):
         """Check if the IP address is private/local."""
-        try:
-            # Simple check for common private IP ranges
-            if ip_address.startswith(('127.', '10.', '192.168.', '172.')):
-                return True
-            return False
-        except:
-            return False
+        return is_private_address(ip_address)
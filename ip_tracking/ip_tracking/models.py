@@ -1,5 +1,27 @@
-from django.db import models
-from django.utils import timezone
+import ipaddress
+import logging
+import threading
+import time
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.models.functions import Now
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# Blocked-IP lookups are cached for a short time to avoid a DB query per request
+BLOCKED_IP_CACHE_TIMEOUT = 60  # seconds
+# Bumped in the shared cache whenever the blocked list changes, so every
+# process reloads its in-process snapshot within a few seconds
+BLOCKED_IP_VERSION_KEY = "blocked_ip:version"
+BLOCKED_IP_VERSION_CHECK_INTERVAL = 5  # seconds
+
+
+def blocked_ip_cache_key(ip_address):
+    """Return the cache key holding the blocked status of an IP address."""
+    return f"blocked_ip:{ip_address}"
+
 
 class RequestLog(models.Model):
     """
@@ -11,7 +33,7 @@ class RequestLog(models.Model):
     )
     timestamp = models.DateTimeField(
         verbose_name="Timestamp",
-        default=timezone.now,
+        db_default=Now(),
         help_text="When the request was made"
     )
     path = models.CharField(
@@ -39,9 +61,15 @@ class RequestLog(models.Model):
         verbose_name_plural = "Request Logs"
         ordering = ['-timestamp']
         indexes = [
-            models.Index(fields=['-timestamp']),
+            # Covers the hourly monitoring query (timestamp range, GROUP BY ip_address,
+            # conditional counts on path) so it can run as an index-only scan.
+            # Leading with timestamp, it also serves the retention purge's range delete.
+            models.Index(
+                fields=['timestamp', 'ip_address'],
+                include=['path', 'id'],
+                name='requestlog_ts_ip_idx',
+            ),
             models.Index(fields=['ip_address']),
-            models.Index(fields=['path']),
             models.Index(fields=['country']),
             models.Index(fields=['city']),
         ]
@@ -52,6 +80,48 @@ class RequestLog(models.Model):
     
     def __repr__(self):
         return f"<RequestLog: {self.ip_address} at {self.timestamp}>"
+    
+    @classmethod
+    def build(cls, ip_address, path, timestamp, country=None, city=None):
+        """
+        Return an unsaved RequestLog whose values fit its columns, or None if ip_address is not a valid IP.
+        Request data is client-controlled, and one row the database rejects fails a whole bulk insert.
+        """
+        try:
+            ip_address = str(ipaddress.ip_address(ip_address))
+        except ValueError:
+            return None
+        
+        return cls(
+            ip_address=ip_address,
+            timestamp=timestamp,
+            path=path[:cls._meta.get_field('path').max_length],
+            country=country[:cls._meta.get_field('country').max_length] if country else country,
+            city=city[:cls._meta.get_field('city').max_length] if city else city,
+        )
+    
+    @classmethod
+    def bulk_insert(cls, request_logs, batch_size):
+        """
+        Insert request logs with bulk_create and return how many were saved.
+        If the database rejects the batch, the rows are retried one by one so a bad row only loses itself.
+        """
+        try:
+            cls.objects.bulk_create(request_logs, batch_size=batch_size)
+            return len(request_logs)
+        except Exception as e:
+            logger.warning("Batch of %d request logs was rejected, saving them one by one: %s", len(request_logs), e)
+        
+        saved = 0
+        for request_log in request_logs:
+            # The failed batch may have assigned ids before rolling back
+            request_log.pk = None
+            try:
+                cls.objects.bulk_create([request_log])
+                saved += 1
+            except Exception as e:
+                logger.error("Failed to save request log for IP %s: %s", request_log.ip_address, e)
+        return saved
 
 
 class BlockedIP(models.Model):
@@ -65,7 +135,7 @@ class BlockedIP(models.Model):
     )
     created_at = models.DateTimeField(
         verbose_name="Blocked At",
-        default=timezone.now,
+        db_default=Now(),
         help_text="When this IP was blocked"
     )
     reason = models.TextField(
@@ -78,8 +148,8 @@ class BlockedIP(models.Model):
         verbose_name = "Blocked IP"
         verbose_name_plural = "Blocked IPs"
         ordering = ['-created_at']
+        # ip_address is unique, so its unique index already serves the per-request lookup
         indexes = [
-            models.Index(fields=['ip_address']),
             models.Index(fields=['-created_at']),
         ]
     
@@ -88,6 +158,162 @@ class BlockedIP(models.Model):
     
     def __repr__(self):
         return f"<BlockedIP: {self.ip_address}>"
+    
+    @classmethod
+    def is_blocked(cls, ip_address):
+        """
+        Check if the given IP address is blocked.
+        Uses the in-process snapshot, then the shared cache, then the database.
+        """
+        # Most IPs are not blocked; answer those without touching cache or DB
+        if not blocked_ip_snapshot.might_contain(ip_address):
+            return False
+        
+        cache_key = blocked_ip_cache_key(ip_address)
+        is_blocked = cache.get(cache_key)
+        
+        if is_blocked is None:
+            is_blocked = cls.objects.filter(ip_address=ip_address).exists()
+            cache.set(cache_key, is_blocked, BLOCKED_IP_CACHE_TIMEOUT)
+        
+        return is_blocked
+    
+    @classmethod
+    def delete_ip(cls, ip_address):
+        """
+        Delete the row for ip_address with one raw DELETE and return the row count.
+        Skips the ORM's collect step and the post_delete signal; call invalidate_cache afterwards.
+        """
+        ip_field = cls._meta.get_field('ip_address')
+        sql = 'DELETE FROM {} WHERE {} = %s'.format(
+            connection.ops.quote_name(cls._meta.db_table),
+            connection.ops.quote_name(ip_field.column),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [ip_field.get_db_prep_value(ip_address, connection)])
+            return cursor.rowcount
+    
+    @classmethod
+    def invalidate_cache(cls, ip_addresses):
+        """
+        Drop the cached status of these IPs and make every process reload its snapshot.
+        Call after changing BlockedIP rows without save()/delete(), e.g. with bulk_create.
+        """
+        cache.delete_many([blocked_ip_cache_key(ip_address) for ip_address in ip_addresses])
+        blocked_ip_snapshot.invalidate()
+        try:
+            cache.incr(BLOCKED_IP_VERSION_KEY)
+        except ValueError:
+            cache.set(BLOCKED_IP_VERSION_KEY, 1, None)
+
+
+class BlockedIPSnapshot:
+    """
+    In-process set of blocked IP addresses, reloaded periodically from the database.
+    Lets BlockedIP.is_blocked skip the cache and database entirely for IPs that are not blocked.
+    Reloads run in a background thread; lookups keep using the previous set until the new one is ready.
+    """
+    
+    def __init__(self, timeout=BLOCKED_IP_CACHE_TIMEOUT, version_check_interval=BLOCKED_IP_VERSION_CHECK_INTERVAL):
+        self.timeout = timeout
+        self.version_check_interval = version_check_interval
+        self._ip_field = BlockedIP._meta.get_field('ip_address')
+        self._ips = None
+        self._version = None
+        self._loaded_at = None
+        self._checked_at = None
+        # Bumped by invalidate(), so a reload that started before a change is discarded
+        self._generation = 0
+        # Held for the duration of a reload, so at most one runs at a time
+        self._reload_lock = threading.Lock()
+    
+    def might_contain(self, ip_address):
+        """Return False if the IP is definitely not blocked, True if it may be."""
+        if self.is_stale():
+            self.refresh()
+        
+        # Until the first load finishes, any IP may be blocked
+        ips = self._ips
+        if ips is None:
+            return True
+        
+        # Normalize the same way the database lookup would (e.g. IPv6 case/compression)
+        try:
+            ip_address = self._ip_field.get_prep_value(ip_address)
+        except Exception:
+            return True
+        
+        return ip_address in ips
+    
+    def is_stale(self):
+        """Return True if the snapshot has expired or the blocked list changed elsewhere."""
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at > self.timeout:
+            return True
+        
+        # Poll the shared version only every few seconds, not on every request
+        if now - self._checked_at > self.version_check_interval:
+            self._checked_at = now
+            return cache.get(BLOCKED_IP_VERSION_KEY) != self._version
+        
+        return False
+    
+    def refresh(self):
+        """Start a background reload unless one is already running; never waits for it."""
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            threading.Thread(target=self._reload_in_background, name='blocked-ip-snapshot', daemon=True).start()
+        except Exception:
+            self._reload_lock.release()
+            raise
+    
+    def reload(self):
+        """Reload the set of blocked IPs from the database, waiting for any reload already running."""
+        with self._reload_lock:
+            self._load()
+    
+    def invalidate(self):
+        """Drop the snapshot; lookups use the cache and database until it is reloaded."""
+        self._generation += 1
+        self._ips = None
+        self._loaded_at = None
+    
+    def _reload_in_background(self):
+        try:
+            self._load()
+        except Exception as e:
+            logger.error("Failed to reload blocked IP snapshot: %s", e)
+        finally:
+            # The thread opened its own database connection
+            connection.close()
+            self._reload_lock.release()
+    
+    def _load(self):
+        generation = self._generation
+        version = cache.get(BLOCKED_IP_VERSION_KEY)
+        if (
+            self._loaded_at is not None
+            and version == self._version
+            and time.monotonic() - self._loaded_at <= self.timeout
+        ):
+            return
+        # Build the new set first, then swap it in with a single assignment
+        ips = frozenset(BlockedIP.objects.values_list('ip_address', flat=True))
+        if generation != self._generation:
+            return
+        self._ips = ips
+        self._version = version
+        self._loaded_at = self._checked_at = time.monotonic()
+
+
+blocked_ip_snapshot = BlockedIPSnapshot()
+
+
+@receiver(post_save, sender=BlockedIP)
+@receiver(post_delete, sender=BlockedIP)
+def invalidate_blocked_ip_cache(sender, instance, **kwargs):
+    BlockedIP.invalidate_cache([instance.ip_address])
 
 
 class IPGeolocationCache(models.Model):
@@ -115,7 +341,7 @@ class IPGeolocationCache(models.Model):
     )
     cached_at = models.DateTimeField(
         verbose_name="Cached At",
-        default=timezone.now,
+        db_default=Now(),
         help_text="When this geolocation data was cached"
     )
     
@@ -123,9 +349,10 @@ class IPGeolocationCache(models.Model):
         verbose_name = "IP Geolocation Cache"
         verbose_name_plural = "IP Geolocation Caches"
         ordering = ['-cached_at']
+        # ip_address is unique, so it is already indexed
         indexes = [
-            models.Index(fields=['ip_address']),
-            models.Index(fields=['cached_at']),
+            # Used by the clear_expired_cache range delete
+            models.Index(fields=['cached_at'], name='geocache_cached_at_idx'),
         ]
     
     def __str__(self):
@@ -135,11 +362,20 @@ class IPGeolocationCache(models.Model):
     def __repr__(self):
         return f"<IPGeolocationCache: {self.ip_address}>"
     
-    def is_expired(self, hours=24):
-        """Check if the cache entry has expired (default: 24 hours)."""
-        from django.utils import timezone
-        from datetime import timedelta
-        return timezone.now() > self.cached_at + timedelta(hours=hours)
+    @classmethod
+    def delete_expired(cls, cutoff_time):
+        """
+        Delete entries cached before cutoff_time with one raw DELETE and return the row count.
+        Skips the ORM's collect/count round-trips; this table has no relations or signals.
+        """
+        cached_at = cls._meta.get_field('cached_at')
+        sql = 'DELETE FROM {} WHERE {} < %s'.format(
+            connection.ops.quote_name(cls._meta.db_table),
+            connection.ops.quote_name(cached_at.column),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [cached_at.get_db_prep_value(cutoff_time, connection)])
+            return cursor.rowcount
 
 
 class SuspiciousIP(models.Model):
@@ -153,6 +389,7 @@ class SuspiciousIP(models.Model):
         ('admin_access', 'Admin Panel Access Attempts'),
         ('brute_force', 'Brute Force Attack Pattern'),
     ]
+    REASON_DISPLAY = dict(SUSPICIOUS_REASONS)
     
     ip_address = models.GenericIPAddressField(
         verbose_name="Suspicious IP Address",
@@ -176,7 +413,7 @@ class SuspiciousIP(models.Model):
     )
     first_seen = models.DateTimeField(
         verbose_name="First Seen",
-        default=timezone.now,
+        db_default=Now(),
         help_text="When this IP was first flagged"
     )
     last_seen = models.DateTimeField(
@@ -210,4 +447,4 @@ class SuspiciousIP(models.Model):
     
     def get_reason_display(self):
         """Get the human-readable reason."""
-        return dict(self.SUSPICIOUS_REASONS).get(self.reason, self.reason)
+        return self.REASON_DISPLAY.get(self.reason, self.reason)
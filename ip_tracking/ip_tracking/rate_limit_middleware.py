@@ -1,11 +1,19 @@
 import time
 import logging
-from django.http import HttpResponseTooManyRequests
+from django.http import HttpResponse
 from django.core.cache import cache
 from django.utils.deprecation import MiddlewareMixin
 
 logger = logging.getLogger(__name__)
 
+# Paths exempt from rate limiting (health checks and static files)
+RATE_LIMIT_SKIP_PATHS = (
+    '/health/',
+    '/static/',
+    '/media/',
+    '/admin/jsi18n/',
+)
+
 
 class RateLimitMiddleware(MiddlewareMixin):
     """
@@ -27,8 +35,8 @@ class RateLimitMiddleware(MiddlewareMixin):
         if self.should_skip_rate_limit(request.path):
             return None
         
-        # Get client IP address
-        ip_address = self.get_client_ip(request)
+        # Get client IP address (already resolved by IPTrackingMiddleware when it runs first)
+        ip_address = getattr(request, 'client_ip', None) or self.get_client_ip(request)
         
         # Determine if user is authenticated
         is_authenticated = request.user.is_authenticated
@@ -36,12 +44,10 @@ class RateLimitMiddleware(MiddlewareMixin):
         # Apply appropriate rate limit
         if is_authenticated:
             limit = self.authenticated_limit
-            user_id = request.user.id
-            cache_key = f"rate_limit_auth_{user_id}_{ip_address}"
+            cache_key = self.get_cache_key(ip_address, request.user)
         else:
             limit = self.anonymous_limit
-            user_id = None
-            cache_key = f"rate_limit_anon_{ip_address}"
+            cache_key = self.get_cache_key(ip_address)
         
         # Check rate limit
         if not self.check_rate_limit(cache_key, limit):
@@ -49,68 +55,70 @@ class RateLimitMiddleware(MiddlewareMixin):
                 f"Rate limit exceeded for {'authenticated' if is_authenticated else 'anonymous'} "
                 f"user from IP: {ip_address}"
             )
-            return HttpResponseTooManyRequests(
+            response = HttpResponse(
                 f"Rate limit exceeded. Maximum {limit} requests per minute allowed.",
-                content_type="text/plain"
+                content_type="text/plain",
+                status=429
             )
+            # Tell the client when the current window ends and requests are allowed again
+            response['Retry-After'] = str(self.seconds_until_next_window())
+            return response
         
         return None
     
     def should_skip_rate_limit(self, path):
         """Determine if rate limiting should be skipped for this path."""
-        # Skip rate limiting for health checks and static files
-        skip_paths = [
-            '/health/',
-            '/static/',
-            '/media/',
-            '/admin/jsi18n/',
-        ]
-        
-        return any(path.startswith(skip_path) for skip_path in skip_paths)
+        # str.startswith accepts a tuple, so all prefixes are checked in one call
+        return path.startswith(RATE_LIMIT_SKIP_PATHS)
     
     def get_client_ip(self, request):
         """Extract the client IP address from the request."""
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
+            # First entry is the original client; partition avoids splitting the whole chain
+            return x_forwarded_for.partition(',')[0].strip()
+        return request.META.get('REMOTE_ADDR')
+    
+    def get_cache_key(self, ip_address, user=None):
+        """Return the rate limit key for an IP address, per user when one is logged in."""
+        if user is not None:
+            return f"rate_limit_auth_{user.id}_{ip_address}"
+        return f"rate_limit_anon_{ip_address}"
+    
+    def get_window_key(self, cache_key):
+        """Return the cache key of the counter for cache_key in the current window."""
+        window_id = int(time.time()) // self.window_size
+        return f"{cache_key}:{window_id}"
+    
+    def reset_rate_limit(self, ip_address, user=None):
+        """Delete the current window's counter for this IP address (and user), e.g. in tests."""
+        cache.delete(self.get_window_key(self.get_cache_key(ip_address, user)))
     
     def check_rate_limit(self, cache_key, limit):
         """
-        Check if the request is within the rate limit.
+        Check if the request is within the rate limit using a fixed-window counter.
         Returns True if the request is allowed, False if rate limit exceeded.
         """
         try:
-            # Get current timestamp
-            now = int(time.time())
+            # One counter per key per window; old windows simply expire
+            window_key = self.get_window_key(cache_key)
             
-            # Get existing requests from cache
-            requests_data = cache.get(cache_key, [])
+            # add() only creates the counter if missing, and incr() is atomic,
+            # so concurrent requests can't lose updates
+            cache.add(window_key, 0, self.window_size + 5)
+            request_count = cache.incr(window_key)
             
-            # Remove requests older than the window
-            window_start = now - self.window_size
-            requests_data = [req_time for req_time in requests_data if req_time > window_start]
-            
-            # Check if adding this request would exceed the limit
-            if len(requests_data) >= limit:
-                return False
-            
-            # Add current request
-            requests_data.append(now)
-            
-            # Store updated requests in cache
-            # Cache for slightly longer than window size to ensure cleanup
-            cache.set(cache_key, requests_data, self.window_size + 10)
-            
-            return True
+            return request_count <= limit
             
         except Exception as e:
             logger.error(f"Error checking rate limit for key {cache_key}: {e}")
             # In case of error, allow the request (fail open)
             return True
     
+    def seconds_until_next_window(self):
+        """Return the number of seconds until the current rate limit window resets."""
+        return self.window_size - int(time.time()) % self.window_size
+    
     def process_response(self, request, response):
         """Process the response (can be used for additional logging if needed)."""
         return response
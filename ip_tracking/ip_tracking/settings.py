@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 import dj_database_url
 
@@ -84,6 +85,10 @@ DATABASES = {
     )
 }
 
+# Optional read replica, configured through the REPLICA_DATABASE_URL environment variable
+if os.environ.get('REPLICA_DATABASE_URL'):
+    DATABASES['replica'] = dj_database_url.parse(os.environ['REPLICA_DATABASE_URL'], conn_max_age=600)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -153,6 +158,21 @@ CACHES = {
     }
 }
 
+# IP Tracking Configuration
+# Hand batched request logs and geolocation cache writes to a Celery worker instead of writing them in the web process
+IP_TRACKING_ASYNC_REQUEST_LOGGING = True
+# Request logs are written in batches of up to this many rows, at least once per flush interval.
+# Keep the batch small enough that one INSERT stays well under the database's statement size limit.
+IP_TRACKING_BULK_BATCH_SIZE = 500
+IP_TRACKING_LOG_FLUSH_INTERVAL = 1.0  # seconds
+# Logs queued beyond this many (e.g. while the database is down) are dropped
+IP_TRACKING_LOG_QUEUE_SIZE = 10000
+# Request logs older than this are deleted daily by purge_old_request_logs
+IP_TRACKING_REQUEST_LOG_RETENTION_DAYS = 7
+# The hourly monitoring scan reads request logs from the replica when one is configured,
+# so long aggregations don't compete with request log inserts on the primary
+IP_TRACKING_MONITOR_DATABASE = 'replica' if 'replica' in DATABASES else 'default'
+
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'  # Redis as message broker
 CELERY_RESULT_BACKEND = None  # No result backend needed for this project
@@ -164,8 +184,8 @@ CELERY_TIMEZONE = 'UTC'
 # Celery Beat Schedule (can also be configured in celery.py)
 CELERY_BEAT_SCHEDULE = {
     'monitor-suspicious-ips': {
-        'task': 'ip_tracking.tasks.monitor_suspicious_ips',
-        'schedule': 3600.0,  # Every hour
+        'task': 'ip_tracking.tasks.fan_out_monitor_suspicious_ips',
+        'schedule': 3600.0,  # Every hour, one task per IP shard
     },
     'cleanup-old-suspicious-flags': {
         'task': 'ip_tracking.tasks.cleanup_old_suspicious_flags',
@@ -175,4 +195,12 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'ip_tracking.tasks.auto_block_suspicious_ips',
         'schedule': 86400.0,  # Every day
     },
+    'clear-expired-geolocation-cache': {
+        'task': 'ip_tracking.tasks.clear_expired_geolocation_cache',
+        'schedule': 3600.0,  # Every hour
+    },
+    'purge-old-request-logs': {
+        'task': 'ip_tracking.tasks.purge_old_request_logs',
+        'schedule': 86400.0,  # Every day
+    },
 }
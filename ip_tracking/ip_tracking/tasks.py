@@ -1,55 +1,181 @@
 from celery import shared_task
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Count, Q
+from django.utils.dateparse import parse_datetime
+from django.db import connection, transaction
+from django.db.models import Count, Exists, OuterRef, Q
+from collections import Counter
 from datetime import timedelta
+from functools import reduce
+from itertools import groupby
+from operator import itemgetter, or_
 import logging
 
-from .models import RequestLog, SuspiciousIP, BlockedIP
+from .models import RequestLog, SuspiciousIP, BlockedIP, IPGeolocationCache
 
 logger = logging.getLogger(__name__)
 
+# Monitoring can be split into shards by the last character of the textual IP
+# (0-9, a-f, or ':' for addresses like 2001:db8::), so all requests from one IP share a shard.
+# The last character spreads addresses far more evenly than the first, which is mostly 1 or 2 for IPv4.
+MONITOR_SHARD_SUFFIXES = tuple('0123456789abcdef:')
+
+# Aggregate rows are streamed and flags upserted in batches of this size
+MONITOR_BATCH_SIZE = 500
+
+# Sensitive path prefixes, each counted under its own aggregate alias
+SENSITIVE_PATHS = [
+    '/admin/',
+    '/api/login/',
+    '/api/dashboard/',
+    '/api/profile/',
+    '/admin/login/',
+]
+SENSITIVE_PATH_ALIASES = {
+    path: f'sensitive_path_{index}_count' for index, path in enumerate(SENSITIVE_PATHS)
+}
+
+# Per-IP aggregates and the "exceeds any threshold" condition, built once at import
+ACTIVITY_COUNTS = {
+    'request_count': Count('id'),
+    'login_attempt_count': Count('id', filter=Q(path='/api/login/')),
+    'admin_access_count': Count('id', filter=Q(path__startswith='/admin/')),
+    **{
+        alias: Count('id', filter=Q(path__startswith=path))
+        for path, alias in SENSITIVE_PATH_ALIASES.items()
+    },
+}
+ACTIVITY_THRESHOLDS = reduce(or_, [
+    Q(request_count__gt=100),
+    Q(login_attempt_count__gt=10),
+    Q(admin_access_count__gt=3),
+    *[Q(**{f'{alias}__gt': 5}) for alias in SENSITIVE_PATH_ALIASES.values()],
+])
+
+
+@shared_task(ignore_result=True)
+def log_request_batch(entries):
+    """
+    Task to write a batch of request logs queued by IPTrackingMiddleware.
+    Each entry is a dict of RequestLog field values with an ISO 8601 timestamp.
+    Invalid entries are skipped, and a rejected batch is saved row by row, so one bad entry never loses the rest.
+    """
+    request_logs = []
+    for entry in entries:
+        try:
+            request_log = RequestLog.build(
+                entry['ip_address'],
+                entry['path'],
+                parse_datetime(entry['timestamp']) or timezone.now(),
+                entry.get('country'),
+                entry.get('city'),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Skipping malformed request log entry {entry!r}: {e}")
+            continue
+        if request_log is None:
+            logger.warning(f"Skipping request log with invalid IP: {entry['ip_address']!r}")
+            continue
+        request_logs.append(request_log)
+    
+    saved = RequestLog.bulk_insert(request_logs, batch_size=getattr(settings, 'IP_TRACKING_BULK_BATCH_SIZE', 500))
+    logger.debug(f"Saved {saved} of {len(entries)} request logs")
+
+
+@shared_task(ignore_result=True)
+def save_ip_geolocation(ip_address, country, city):
+    """
+    Task to persist geolocation data fetched by IPTrackingMiddleware.
+    The database copy outlives the shared cache, e.g. across cache restarts.
+    """
+    IPGeolocationCache.objects.update_or_create(
+        ip_address=ip_address,
+        defaults={
+            'country': country,
+            'city': city,
+            'cached_at': timezone.now()
+        }
+    )
+    logger.debug(f"Saved geolocation data for IP: {ip_address}")
+
+
+@shared_task
+def fan_out_monitor_suspicious_ips():
+    """
+    Hourly task that queues one monitor_suspicious_ips task per IP shard.
+    Shards run in parallel across workers instead of as one long task.
+    """
+    for shard in range(len(MONITOR_SHARD_SUFFIXES)):
+        monitor_suspicious_ips.delay(shard=shard)
+    
+    logger.info(f"Queued suspicious IP monitoring for {len(MONITOR_SHARD_SUFFIXES)} shards")
+    
+    return {'shards': len(MONITOR_SHARD_SUFFIXES)}
+
 
 @shared_task
-def monitor_suspicious_ips():
+def monitor_suspicious_ips(shard=None):
     """
-    Hourly task to monitor and flag suspicious IP activity.
+    Task to monitor and flag suspicious IP activity in the last hour.
+    Checks every IP, or only the IPs in one shard of MONITOR_SHARD_SUFFIXES.
     Flags IPs that:
     - Exceed 100 requests per hour
     - Access sensitive paths frequently
     - Show patterns of suspicious behavior
     """
-    logger.info("Starting suspicious IP monitoring task")
+    shard_info = f" (shard {shard})" if shard is not None else ""
+    logger.info(f"Starting suspicious IP monitoring task{shard_info}")
     
     # Calculate time window (last hour)
     one_hour_ago = timezone.now() - timedelta(hours=1)
     
     try:
-        # 1. Check for high volume requests (>100 per hour)
-        high_volume_ips = check_high_volume_ips(one_hour_ago)
-        
-        # 2. Check for sensitive path access
-        sensitive_path_ips = check_sensitive_path_access(one_hour_ago)
-        
-        # 3. Check for failed login attempts
-        failed_login_ips = check_failed_login_attempts(one_hour_ago)
-        
-        # 4. Check for admin panel access attempts
-        admin_access_ips = check_admin_access_attempts(one_hour_ago)
+        flag_counts = Counter()
+        pending_flags = []
         
-        # 5. Check for brute force patterns
-        brute_force_ips = check_brute_force_patterns(one_hour_ago)
+        # Write all flags in one transaction: one commit instead of one per batch
+        with transaction.atomic():
+            relax_commit_durability()
+            
+            # One pass over the last hour's requests; each row carries every counter the checks need.
+            # Rows are streamed and flags written in batches so memory stays bounded for large shards
+            for activity in aggregate_ip_activity(one_hour_ago, shard).iterator(chunk_size=MONITOR_BATCH_SIZE):
+                # 1. Check for high volume requests (>100 per hour)
+                high_volume_flag = check_high_volume(activity)
+                
+                flags = [
+                    high_volume_flag,
+                    # 2. Check for sensitive path access
+                    check_sensitive_path_access(activity),
+                    # 3. Check for failed login attempts
+                    check_failed_login_attempts(activity),
+                    # 4. Check for admin panel access attempts
+                    check_admin_access_attempts(activity),
+                    # 5. Check for brute force patterns, skipping IPs just flagged for high volume
+                    None if high_volume_flag else check_brute_force_pattern(activity),
+                ]
+                for flag in flags:
+                    if flag:
+                        flag_counts[flag.reason] += 1
+                        pending_flags.append(flag)
+                
+                if len(pending_flags) >= MONITOR_BATCH_SIZE:
+                    save_suspicious_ip_flags(pending_flags)
+                    pending_flags = []
+            
+            save_suspicious_ip_flags(pending_flags)
         
         # Summary
-        total_flagged = len(high_volume_ips) + len(sensitive_path_ips) + len(failed_login_ips) + len(admin_access_ips) + len(brute_force_ips)
+        total_flagged = sum(flag_counts.values())
         
-        logger.info(f"Suspicious IP monitoring completed. Flagged {total_flagged} IPs")
+        logger.info(f"Suspicious IP monitoring completed{shard_info}. Flagged {total_flagged} IPs")
         
         return {
-            'high_volume': len(high_volume_ips),
-            'sensitive_paths': len(sensitive_path_ips),
-            'failed_logins': len(failed_login_ips),
-            'admin_access': len(admin_access_ips),
-            'brute_force': len(brute_force_ips),
+            'high_volume': flag_counts['high_volume'],
+            'sensitive_paths': flag_counts['sensitive_paths'],
+            'failed_logins': flag_counts['failed_logins'],
+            'admin_access': flag_counts['admin_access'],
+            'brute_force': flag_counts['brute_force'],
             'total': total_flagged
         }
         
@@ -58,235 +184,174 @@ def monitor_suspicious_ips():
         raise
 
 
-def check_high_volume_ips(since_time):
-    """Check for IPs with more than 100 requests in the last hour."""
-    logger.info("Checking for high volume IPs...")
+def relax_commit_durability():
+    """
+    Let the current transaction commit without waiting for its WAL flush (PostgreSQL only).
+    Flags are recomputed every hour, so a crash can at worst lose the latest monitoring run.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL synchronous_commit = OFF')
+
+
+def recent_requests(since_time, shard=None):
+    """
+    Return request logs since since_time, limited to one IP shard if given.
+    Reads from IP_TRACKING_MONITOR_DATABASE (a read replica, when configured).
+    """
+    database = getattr(settings, 'IP_TRACKING_MONITOR_DATABASE', 'default')
+    queryset = RequestLog.objects.using(database).filter(timestamp__gte=since_time)
+    if shard is not None:
+        queryset = queryset.filter(ip_address__endswith=MONITOR_SHARD_SUFFIXES[shard])
+    return queryset
+
+
+def aggregate_ip_activity(since_time, shard=None):
+    """
+    Count each IP's requests since since_time in a single query using conditional aggregates.
+    Returns one row per IP that exceeds at least one monitoring threshold.
+    """
+    logger.info("Aggregating request activity per IP...")
     
-    # Get IPs with >100 requests in the last hour
-    high_volume = (
-        RequestLog.objects
-        .filter(timestamp__gte=since_time)
+    return (
+        recent_requests(since_time, shard)
         .values('ip_address')
-        .annotate(request_count=Count('id'))
-        .filter(request_count__gt=100)
+        .annotate(
+            **ACTIVITY_COUNTS,
+            # Whether the IP has ever been flagged for high volume (used by the brute force check)
+            has_high_volume_flag=Exists(
+                SuspiciousIP.objects.filter(ip_address=OuterRef('ip_address'), reason='high_volume')
+            ),
+        )
+        .filter(ACTIVITY_THRESHOLDS)
     )
+
+
+def flag_suspicious_ip(ip_address, reason, details, request_count):
+    """Build an unsaved SuspiciousIP record for this IP and reason."""
+    return SuspiciousIP(
+        ip_address=ip_address,
+        reason=reason,
+        details=details,
+        request_count=request_count,
+        is_active=True,
+    )
+
+
+def save_suspicious_ip_flags(flags):
+    """
+    Insert the given SuspiciousIP records, refreshing any existing record
+    for the same IP and reason instead of creating a duplicate.
+    """
+    SuspiciousIP.objects.bulk_create(
+        flags,
+        batch_size=MONITOR_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['ip_address', 'reason'],
+        update_fields=['details', 'request_count', 'is_active', 'last_seen'],
+    )
+
+
+def check_high_volume(activity):
+    """Flag an IP with more than 100 requests in the last hour."""
+    ip_address = activity['ip_address']
+    request_count = activity['request_count']
     
-    flagged_ips = []
-    for item in high_volume:
-        ip_address = item['ip_address']
-        request_count = item['request_count']
-        
-        # Create or update SuspiciousIP record
-        suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-            ip_address=ip_address,
-            reason='high_volume',
-            defaults={
-                'details': f'IP made {request_count} requests in the last hour (threshold: 100)',
-                'request_count': request_count,
-            }
-        )
-        
-        if not created:
-            # Update existing record
-            suspicious_ip.details = f'IP made {request_count} requests in the last hour (threshold: 100)'
-            suspicious_ip.request_count = request_count
-            suspicious_ip.is_active = True
-            suspicious_ip.save()
-        
-        flagged_ips.append(ip_address)
-        logger.warning(f"Flagged IP {ip_address} for high volume: {request_count} requests")
+    if request_count <= 100:
+        return None
     
-    return flagged_ips
+    suspicious_ip = flag_suspicious_ip(
+        ip_address,
+        'high_volume',
+        f'IP made {request_count} requests in the last hour (threshold: 100)',
+        request_count
+    )
+    logger.warning(f"Flagged IP {ip_address} for high volume: {request_count} requests")
+    return suspicious_ip
 
 
-def check_sensitive_path_access(since_time):
-    """Check for IPs accessing sensitive paths frequently."""
-    logger.info("Checking for sensitive path access...")
+def check_sensitive_path_access(activity):
+    """Flag an IP that accessed a sensitive path more than 5 times in the last hour."""
+    ip_address = activity['ip_address']
     
-    # Define sensitive paths
-    sensitive_paths = [
-        '/admin/',
-        '/api/login/',
-        '/api/dashboard/',
-        '/api/profile/',
-        '/admin/login/',
+    exceeded = [
+        (path, activity[alias])
+        for path, alias in SENSITIVE_PATH_ALIASES.items()
+        if activity[alias] > 5  # More than 5 attempts to sensitive path
     ]
+    if not exceeded:
+        return None
     
-    flagged_ips = []
-    
-    for path in sensitive_paths:
-        # Get IPs that accessed this sensitive path multiple times
-        sensitive_access = (
-            RequestLog.objects
-            .filter(
-                timestamp__gte=since_time,
-                path__startswith=path
-            )
-            .values('ip_address')
-            .annotate(access_count=Count('id'))
-            .filter(access_count__gt=5)  # More than 5 attempts to sensitive path
-        )
-        
-        for item in sensitive_access:
-            ip_address = item['ip_address']
-            access_count = item['access_count']
-            
-            # Create or update SuspiciousIP record
-            suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-                ip_address=ip_address,
-                reason='sensitive_paths',
-                defaults={
-                    'details': f'IP accessed sensitive path {path} {access_count} times in the last hour',
-                    'request_count': access_count,
-                }
-            )
-            
-            if not created:
-                # Update existing record
-                suspicious_ip.details = f'IP accessed sensitive path {path} {access_count} times in the last hour'
-                suspicious_ip.request_count = access_count
-                suspicious_ip.is_active = True
-                suspicious_ip.save()
-            
-            if ip_address not in flagged_ips:
-                flagged_ips.append(ip_address)
-                logger.warning(f"Flagged IP {ip_address} for sensitive path access: {path} ({access_count} times)")
-    
-    return flagged_ips
+    # One record per IP; the last matching path wins, as when each path was checked in turn
+    path, access_count = exceeded[-1]
+    suspicious_ip = flag_suspicious_ip(
+        ip_address,
+        'sensitive_paths',
+        f'IP accessed sensitive path {path} {access_count} times in the last hour',
+        access_count
+    )
+    logger.warning(f"Flagged IP {ip_address} for sensitive path access: {path} ({access_count} times)")
+    return suspicious_ip
 
 
-def check_failed_login_attempts(since_time):
-    """Check for IPs with multiple failed login attempts."""
-    logger.info("Checking for failed login attempts...")
-    
-    # This would need to be implemented based on your login failure tracking
-    # For now, we'll check for multiple POST requests to login endpoint
-    failed_logins = (
-        RequestLog.objects
-        .filter(
-            timestamp__gte=since_time,
-            path='/api/login/'
-        )
-        .values('ip_address')
-        .annotate(attempt_count=Count('id'))
-        .filter(attempt_count__gt=10)  # More than 10 login attempts
-    )
+def check_failed_login_attempts(activity):
+    """Flag an IP with more than 10 login attempts in the last hour."""
+    # Login failures aren't tracked separately, so this counts requests to the login endpoint
+    ip_address = activity['ip_address']
+    attempt_count = activity['login_attempt_count']
     
-    flagged_ips = []
-    for item in failed_logins:
-        ip_address = item['ip_address']
-        attempt_count = item['attempt_count']
-        
-        # Create or update SuspiciousIP record
-        suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-            ip_address=ip_address,
-            reason='failed_logins',
-            defaults={
-                'details': f'IP made {attempt_count} login attempts in the last hour',
-                'request_count': attempt_count,
-            }
-        )
-        
-        if not created:
-            # Update existing record
-            suspicious_ip.details = f'IP made {attempt_count} login attempts in the last hour'
-            suspicious_ip.request_count = attempt_count
-            suspicious_ip.is_active = True
-            suspicious_ip.save()
-        
-        flagged_ips.append(ip_address)
-        logger.warning(f"Flagged IP {ip_address} for failed login attempts: {attempt_count} attempts")
+    if attempt_count <= 10:
+        return None
     
-    return flagged_ips
+    suspicious_ip = flag_suspicious_ip(
+        ip_address,
+        'failed_logins',
+        f'IP made {attempt_count} login attempts in the last hour',
+        attempt_count
+    )
+    logger.warning(f"Flagged IP {ip_address} for failed login attempts: {attempt_count} attempts")
+    return suspicious_ip
 
 
-def check_admin_access_attempts(since_time):
-    """Check for IPs attempting to access admin panel."""
-    logger.info("Checking for admin access attempts...")
+def check_admin_access_attempts(activity):
+    """Flag an IP with more than 3 admin panel requests in the last hour."""
+    ip_address = activity['ip_address']
+    access_count = activity['admin_access_count']
     
-    admin_access = (
-        RequestLog.objects
-        .filter(
-            timestamp__gte=since_time,
-            path__startswith='/admin/'
-        )
-        .values('ip_address')
-        .annotate(access_count=Count('id'))
-        .filter(access_count__gt=3)  # More than 3 admin access attempts
-    )
+    if access_count <= 3:
+        return None
     
-    flagged_ips = []
-    for item in admin_access:
-        ip_address = item['ip_address']
-        access_count = item['access_count']
-        
-        # Create or update SuspiciousIP record
-        suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-            ip_address=ip_address,
-            reason='admin_access',
-            defaults={
-                'details': f'IP attempted admin access {access_count} times in the last hour',
-                'request_count': access_count,
-            }
-        )
-        
-        if not created:
-            # Update existing record
-            suspicious_ip.details = f'IP attempted admin access {access_count} times in the last hour'
-            suspicious_ip.request_count = access_count
-            suspicious_ip.is_active = True
-            suspicious_ip.save()
-        
-        flagged_ips.append(ip_address)
-        logger.warning(f"Flagged IP {ip_address} for admin access attempts: {access_count} attempts")
-    
-    return flagged_ips
+    suspicious_ip = flag_suspicious_ip(
+        ip_address,
+        'admin_access',
+        f'IP attempted admin access {access_count} times in the last hour',
+        access_count
+    )
+    logger.warning(f"Flagged IP {ip_address} for admin access attempts: {access_count} attempts")
+    return suspicious_ip
 
 
-def check_brute_force_patterns(since_time):
-    """Check for brute force attack patterns."""
-    logger.info("Checking for brute force patterns...")
-    
-    # Look for IPs with rapid successive requests (potential automated attacks)
+def check_brute_force_pattern(activity):
+    """Flag an IP with a very high request rate (more than 200 requests per hour)."""
     # This is a simplified check - in production you might want more sophisticated pattern detection
+    ip_address = activity['ip_address']
+    request_count = activity['request_count']
     
-    # Get IPs with very high request rates (more than 200 requests per hour)
-    brute_force_candidates = (
-        RequestLog.objects
-        .filter(timestamp__gte=since_time)
-        .values('ip_address')
-        .annotate(request_count=Count('id'))
-        .filter(request_count__gt=200)  # Very high volume
-    )
+    if request_count <= 200:
+        return None
     
-    flagged_ips = []
-    for item in brute_force_candidates:
-        ip_address = item['ip_address']
-        request_count = item['request_count']
-        
-        # Check if this IP is already flagged for high volume
-        if not SuspiciousIP.objects.filter(ip_address=ip_address, reason='high_volume').exists():
-            # Create or update SuspiciousIP record
-            suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-                ip_address=ip_address,
-                reason='brute_force',
-                defaults={
-                    'details': f'IP shows brute force pattern with {request_count} requests in the last hour',
-                    'request_count': request_count,
-                }
-            )
-            
-            if not created:
-                # Update existing record
-                suspicious_ip.details = f'IP shows brute force pattern with {request_count} requests in the last hour'
-                suspicious_ip.request_count = request_count
-                suspicious_ip.is_active = True
-                suspicious_ip.save()
-            
-            flagged_ips.append(ip_address)
-            logger.warning(f"Flagged IP {ip_address} for brute force pattern: {request_count} requests")
+    # Skip IPs already flagged for high volume
+    if activity['has_high_volume_flag']:
+        return None
     
-    return flagged_ips
+    suspicious_ip = flag_suspicious_ip(
+        ip_address,
+        'brute_force',
+        f'IP shows brute force pattern with {request_count} requests in the last hour',
+        request_count
+    )
+    logger.warning(f"Flagged IP {ip_address} for brute force pattern: {request_count} requests")
+    return suspicious_ip
 
 
 @shared_task
@@ -300,14 +365,11 @@ def cleanup_old_suspicious_flags():
     seven_days_ago = timezone.now() - timedelta(days=7)
     
     try:
-        # Deactivate old flags
-        old_flags = SuspiciousIP.objects.filter(
+        # Deactivate old flags; update() returns the number of rows changed
+        count = SuspiciousIP.objects.filter(
             last_seen__lt=seven_days_ago,
             is_active=True
-        )
-        
-        count = old_flags.count()
-        old_flags.update(is_active=False)
+        ).update(is_active=False)
         
         logger.info(f"Deactivated {count} old suspicious IP flags")
         
@@ -318,6 +380,61 @@ def cleanup_old_suspicious_flags():
         raise
 
 
+@shared_task
+def clear_expired_geolocation_cache():
+    """
+    Hourly task to delete geolocation cache entries older than 24 hours.
+    Keeps the cache table bounded without running clear_expired_cache by hand.
+    """
+    logger.info("Starting cleanup of expired geolocation cache entries...")
+    
+    cutoff_time = timezone.now() - timedelta(hours=24)
+    
+    try:
+        count = IPGeolocationCache.delete_expired(cutoff_time)
+        
+        logger.info(f"Deleted {count} expired geolocation cache entries")
+        
+        return {'deleted_count': count}
+        
+    except Exception as e:
+        logger.error(f"Error in geolocation cache cleanup task: {e}")
+        raise
+
+
+@shared_task
+def purge_old_request_logs():
+    """
+    Daily task to delete request logs older than the retention period.
+    Keeps RequestLog small so the hourly monitoring scan stays fast.
+    Rows are deleted in batches to avoid holding long locks on the table.
+    """
+    logger.info("Starting purge of old request logs...")
+    
+    retention_days = getattr(settings, 'IP_TRACKING_REQUEST_LOG_RETENTION_DAYS', 7)
+    batch_size = getattr(settings, 'IP_TRACKING_BULK_BATCH_SIZE', 500)
+    cutoff_time = timezone.now() - timedelta(days=retention_days)
+    
+    try:
+        old_logs = RequestLog.objects.filter(timestamp__lt=cutoff_time)
+        
+        count = 0
+        while True:
+            batch_ids = list(old_logs.values_list('id', flat=True)[:batch_size])
+            if not batch_ids:
+                break
+            deleted, _ = RequestLog.objects.filter(id__in=batch_ids).delete()
+            count += deleted
+        
+        logger.info(f"Deleted {count} request logs older than {retention_days} days")
+        
+        return {'deleted_count': count}
+        
+    except Exception as e:
+        logger.error(f"Error in request log purge task: {e}")
+        raise
+
+
 @shared_task
 def auto_block_suspicious_ips():
     """
@@ -327,37 +444,42 @@ def auto_block_suspicious_ips():
     logger.info("Starting automatic blocking of severely suspicious IPs...")
     
     try:
-        # Find IPs flagged for multiple reasons
+        # Find IPs flagged for multiple reasons that are not blocked yet
         severely_suspicious = (
             SuspiciousIP.objects
             .filter(is_active=True)
+            .exclude(ip_address__in=BlockedIP.objects.values('ip_address'))
             .values('ip_address')
             .annotate(flag_count=Count('reason'))
             .filter(flag_count__gte=3)  # Flagged for 3 or more different reasons
         )
         
-        blocked_count = 0
-        for item in severely_suspicious:
-            ip_address = item['ip_address']
+        # Load the reasons for every such IP in one query, grouped by IP
+        active_flags = (
+            SuspiciousIP.objects
+            .filter(is_active=True, ip_address__in=severely_suspicious.values('ip_address'))
+            .order_by('ip_address', '-last_seen')
+            .values_list('ip_address', 'reason')
+        )
+        
+        to_block = []
+        for ip_address, flags in groupby(active_flags, key=itemgetter(0)):
+            reason_text = ', '.join([SuspiciousIP.REASON_DISPLAY[reason] for _, reason in flags])
             
-            # Check if IP is already blocked
-            if not BlockedIP.objects.filter(ip_address=ip_address).exists():
-                # Get all reasons for this IP
-                reasons = SuspiciousIP.objects.filter(
-                    ip_address=ip_address,
-                    is_active=True
-                ).values_list('reason', flat=True)
-                
-                reason_text = ', '.join([dict(SuspiciousIP.SUSPICIOUS_REASONS)[r] for r in reasons])
-                
-                # Create blocked IP record
-                BlockedIP.objects.create(
-                    ip_address=ip_address,
-                    reason=f"Auto-blocked due to multiple suspicious activities: {reason_text}"
-                )
-                
-                blocked_count += 1
-                logger.warning(f"Auto-blocked IP {ip_address} for multiple suspicious activities: {reason_text}")
+            to_block.append(BlockedIP(
+                ip_address=ip_address,
+                reason=f"Auto-blocked due to multiple suspicious activities: {reason_text}"
+            ))
+            logger.warning(f"Auto-blocked IP {ip_address} for multiple suspicious activities: {reason_text}")
+        
+        # Create the blocked IP records in bulk; skip any blocked since the query ran
+        BlockedIP.objects.bulk_create(
+            to_block,
+            batch_size=getattr(settings, 'IP_TRACKING_BULK_BATCH_SIZE', 500),
+            ignore_conflicts=True
+        )
+        BlockedIP.invalidate_cache([blocked_ip.ip_address for blocked_ip in to_block])
+        blocked_count = len(to_block)
         
         logger.info(f"Auto-blocked {blocked_count} severely suspicious IPs")
         
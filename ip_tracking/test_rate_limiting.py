@@ -4,95 +4,123 @@ Simple test script to demonstrate rate limiting functionality.
 This script can be used to test the rate limiting from outside Django.
 """
 
+import getpass
+import sys
 import requests
-import time
+import urllib3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import json
 
 # Configuration
 BASE_URL = "http://localhost:8000"  # Change this to your Django server URL
 LOGIN_ENDPOINT = f"{BASE_URL}/api/login/"
 TEST_ENDPOINT = f"{BASE_URL}/api/test-rate-limit/"
+JSON_HEADERS = {"Content-Type": "application/json"}
 
-def test_anonymous_rate_limit():
-    """Test rate limiting for anonymous users (limit: 5 requests/minute)."""
-    print("Testing Anonymous User Rate Limiting (5 requests/minute)")
+# Probes in a burst are sent concurrently; the largest burst is 12 requests
+MAX_CONCURRENT_REQUESTS = 12
+
+# The login goes through a requests session, which keeps the login cookie
+SESSION = requests.Session()
+
+# Probes only need the status code, so they skip requests' cookie, redirect and
+# body handling and go straight to urllib3. Connections are kept alive and reused;
+# the pool holds one connection per concurrent request.
+HTTP = urllib3.PoolManager(maxsize=MAX_CONCURRENT_REQUESTS, block=True, retries=False)
+PROBE_TIMEOUT = urllib3.Timeout(total=5)
+
+# Output for the expected status codes; anything else is reported as unexpected
+STATUS_LABELS = {
+    200: "SUCCESS (200)",
+    429: "BLOCKED (429) - Rate limit exceeded",
+}
+
+# One line of burst output: request number, then its status label
+RESULT_LINE = "Request {}: {}"
+
+# Worker threads are started once and reused by every burst
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
+
+def send_burst(session, url, count):
+    """Send count GET requests to url at once; return their futures in order."""
+    # Build the headers once (including the session's current cookies)
+    # and send the same request count times
+    headers = dict(session.prepare_request(requests.Request("GET", url)).headers)
+    return [EXECUTOR.submit(send_probe, url, headers) for _ in range(count)]
+
+def send_probe(url, headers):
+    """Send one probe and return its status code."""
+    response = HTTP.request("GET", url, headers=headers, timeout=PROBE_TIMEOUT, preload_content=False)
+    # Only the status code matters: don't load the body, just discard it so
+    # the connection goes straight back to the pool for the next probe
+    response.drain_conn()
+    response.release_conn()
+    return response.status
+
+def describe_outcome(outcome):
+    """Describe one request's outcome (its status code or the exception it raised)."""
+    if isinstance(outcome, Exception):
+        return f"ERROR - {outcome}"
+    return STATUS_LABELS.get(outcome) or f"UNEXPECTED ({outcome})"
+
+def run_probe_burst(session, url, count, label):
+    """Send a burst of count probes to url, print each result and a summary; return (successful, blocked)."""
+    print(f"\nTesting {label}")
     print("=" * 60)
     
-    successful = 0
-    blocked = 0
+    futures = send_burst(session, url, count)
     
-    for i in range(7):  # Try to exceed the 5 request limit
+    # Collect (request number, status code or error) and print once, after the burst
+    results = []
+    for i, future in enumerate(futures):
         try:
-            response = requests.get(TEST_ENDPOINT, timeout=5)
-            
-            if response.status_code == 200:
-                successful += 1
-                print(f"Request {i+1}: SUCCESS (200)")
-            elif response.status_code == 429:
-                blocked += 1
-                print(f"Request {i+1}: BLOCKED (429) - Rate limit exceeded")
-            else:
-                print(f"Request {i+1}: UNEXPECTED ({response.status_code})")
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Request {i+1}: ERROR - {e}")
-        
-        time.sleep(0.1)  # Small delay between requests
+            results.append((i+1, future.result()))
+        except urllib3.exceptions.HTTPError as e:
+            results.append((i+1, e))
+    
+    lines = [RESULT_LINE.format(number, describe_outcome(outcome)) for number, outcome in results]
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+    
+    counts = Counter(outcome for _, outcome in results if not isinstance(outcome, Exception))
+    successful = counts[200]
+    blocked = counts[429]
     
     print(f"\nSummary: {successful} successful, {blocked} blocked")
+    for code, n in counts.items():
+        if code not in STATUS_LABELS:
+            print(f"UNEXPECTED {code}: {n}")
     return successful, blocked
 
-def test_authenticated_rate_limit(username, password):
-    """Test rate limiting for authenticated users (limit: 10 requests/minute)."""
-    print(f"\nTesting Authenticated User Rate Limiting (10 requests/minute)")
-    print(f"Username: {username}")
-    print("=" * 60)
+def test_anonymous_rate_limit():
+    """Test rate limiting for anonymous users (limit: 5 requests/minute)."""
+    # Try to exceed the 5 request limit
+    return run_probe_burst(SESSION, TEST_ENDPOINT, 7, "Anonymous User Rate Limiting (5 requests/minute)")
+
+def login(session, username, password):
+    """Log in once; the session keeps the login cookies for every later request. Return True on success."""
+    print(f"\nLogging in as {username}")
     
-    # First, try to login
-    login_data = {
-        "username": username,
-        "password": password
-    }
+    # Encode the JSON body once, up front
+    login_body = json.dumps({"username": username, "password": password}, separators=(",", ":")).encode("utf-8")
     
     try:
-        login_response = requests.post(LOGIN_ENDPOINT, json=login_data, timeout=5)
+        login_response = session.post(LOGIN_ENDPOINT, data=login_body, headers=JSON_HEADERS, timeout=5)
         
         if login_response.status_code == 200:
             print("✓ Login successful")
-            # Get session cookies
-            cookies = login_response.cookies
-        else:
-            print(f"✗ Login failed: {login_response.status_code}")
-            print(f"Response: {login_response.text}")
-            return
+            return True
+        print(f"✗ Login failed: {login_response.status_code}")
+        print(f"Response: {login_response.text}")
     except requests.exceptions.RequestException as e:
         print(f"✗ Login error: {e}")
-        return
-    
-    # Test rate limiting with authenticated session
-    successful = 0
-    blocked = 0
-    
-    for i in range(12):  # Try to exceed the 10 request limit
-        try:
-            response = requests.get(TEST_ENDPOINT, cookies=cookies, timeout=5)
-            
-            if response.status_code == 200:
-                successful += 1
-                print(f"Request {i+1}: SUCCESS (200)")
-            elif response.status_code == 429:
-                blocked += 1
-                print(f"Request {i+1}: BLOCKED (429) - Rate limit exceeded")
-            else:
-                print(f"Request {i+1}: UNEXPECTED ({response.status_code})")
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Request {i+1}: ERROR - {e}")
-        
-        time.sleep(0.1)  # Small delay between requests
-    
-    print(f"\nSummary: {successful} successful, {blocked} blocked")
-    return successful, blocked
+    return False
+
+def run_authenticated_probes(session, count):
+    """Test rate limiting for authenticated users (limit: 10 requests/minute) with a logged-in session."""
+    return run_probe_burst(session, TEST_ENDPOINT, count, "Authenticated User Rate Limiting (10 requests/minute)")
 
 def main():
     """Main test function."""
@@ -102,12 +130,17 @@ def main():
     # Test anonymous rate limiting
     anon_success, anon_blocked = test_anonymous_rate_limit()
     
+    # Stay None unless the authenticated test runs
+    auth_success = auth_blocked = None
+    
     # Test authenticated rate limiting (if credentials provided)
     username = input("\nEnter username for authenticated test (or press Enter to skip): ").strip()
     if username:
-        password = input("Enter password: ").strip()
+        password = getpass.getpass("Enter password: ")  # Not echoed to the terminal
+        # Log in once; every authenticated test reuses the logged-in session
         if password:
-            auth_success, auth_blocked = test_authenticated_rate_limit(username, password)
+            if login(SESSION, username, password):
+                auth_success, auth_blocked = run_authenticated_probes(SESSION, 12)  # Try to exceed the 10 request limit
         else:
             print("No password provided, skipping authenticated test")
     else:
@@ -119,7 +152,7 @@ def main():
     print("=" * 40)
     print(f"Anonymous users: {anon_success} successful, {anon_blocked} blocked")
     
-    if 'auth_success' in locals():
+    if auth_success is not None:
         print(f"Authenticated users: {auth_success} successful, {auth_blocked} blocked")
     
     print("\nRate limiting is working correctly if:")